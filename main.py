@@ -1,12 +1,26 @@
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
-import requests
-from fastapi import FastAPI, HTTPException, Request, Depends
+import sys
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+import httpx
+import orjson
+import redis.asyncio
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import fastapi.responses
 
+logger = logging.getLogger(__name__)
+
 # 1. .env 로드
 env_path = os.path.join(os.path.dirname(__file__), ".env")
 if os.path.exists(env_path):
@@ -14,28 +28,96 @@ if os.path.exists(env_path):
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 API_TOKEN = os.getenv("API_TOKEN", "defaultapitoken")
+# 1 이면 의미 기반(임베딩) 캐시 사용. sentence-transformers, faiss-cpu 설치 필요
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE") == "1"
+# 있으면 /chat 캐시를 Redis 에 둬서 워커들이 같이 쓴다. 없으면 프로세스 안 메모리 캐시
+REDIS_URL = os.getenv("REDIS_URL")
 
 if not GEMINI_API_KEY:
     raise RuntimeError("GEMINI_API_KEY 가 없습니다. Render 환경변수에 추가하세요.")
 
-V1BETA_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
-
-app = FastAPI()
+GOOGLE_API_BASE_URL = "https://generativelanguage.googleapis.com"
+
+# 요청마다 문자열/딕셔너리를 새로 만들지 않도록 미리 만들어 둔다
+_KEY_PARAMS = {"key": GEMINI_API_KEY}
+_MODELS_PATH = "/v1beta/models"
+_JSON_HEADERS = {"content-type": "application/json"}
+
+# 구글 API 호출용 공용 클라이언트 (커넥션 풀 재사용 → 매 요청 TCP/TLS 핸드셰이크 생략)
+# 프로세스당 하나만 만들고, import 시점이 아니라 처음 쓸 때(이벤트 루프 안에서) 만든다
+_client: httpx.AsyncClient | None = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=GOOGLE_API_BASE_URL,
+            timeout=30,
+            # 연결 실패는 2번까지 재시도. transport 를 직접 주면 limits/http2 도 여기서 줘야 한다
+            transport=httpx.AsyncHTTPTransport(
+                retries=2,
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+            ),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _redis
+    if REDIS_URL:
+        # 기본 풀은 연결이 다 차면 기다리지 않고 에러를 내서 부하가 몰릴 때 캐시가 꺼진다.
+        # BlockingConnectionPool 은 빈 연결을 잠깐 기다린다. Redis 가 멈춰도 /chat 이 같이 멈추지 않게 타임아웃도 짧게
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            REDIS_URL,
+            max_connections=32,
+            timeout=REDIS_TIMEOUT,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT,
+        )
+        _redis = redis.asyncio.Redis.from_pool(pool)  # aclose() 때 풀도 같이 닫힌다
+    # 첫 요청이 빠르도록 모델 선택을 미리 해 둔다 (실패하면 첫 요청 때 다시 시도).
+    # 이 GET 으로 DNS 조회, TLS 핸드셰이크, HTTP/2 연결도 미리 끝난다.
+    # 구글이 느리거나 JSON 이 아닌 에러 페이지를 줘도 서버는 떠야 하니 짧게 끊고 무시한다
+    try:
+        await asyncio.wait_for(get_text_model(), timeout=MODEL_WARMUP_TIMEOUT)
+    except (HTTPException, httpx.HTTPError, ValueError, TimeoutError):
+        pass
+    yield
+    await close_client()
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS
+# 미들웨어는 순수 ASGI 인 CORSMiddleware 만 쓴다.
+# BaseHTTPMiddleware 는 요청마다 지연이 붙고 스트리밍 응답을 깨뜨릴 수 있으니 추가 금지.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=("*",),
     allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["Content-Type", "X-API-KEY", "Authorization"],
+    allow_methods=("GET", "POST", "OPTIONS"),
+    allow_headers=("Content-Type", "X-API-KEY", "Authorization"),
 )
 
 api_key_header = APIKeyHeader(name="X-API-KEY")
+_API_TOKEN_B = API_TOKEN.encode()  # 비교할 때마다 encode 하지 않게 미리
 
 
-def verify_api_key(api_key: str = Depends(api_key_header)):
-    if api_key != API_TOKEN:
+async def verify_api_key(api_key: str = Depends(api_key_header)):
+    if not api_key or not hmac.compare_digest(api_key.encode(), _API_TOKEN_B):
         raise HTTPException(status_code=401, detail={"error": "Invalid API Token"})
 
 
@@ -43,11 +125,132 @@ class ChatRequest(BaseModel):
     prompt: str
 
 
-def list_models_v1beta() -> list[dict]:
+class ChatResponse(BaseModel):
+    response: str
+    model_used: str | None = None  # 후보가 없어서 빈 응답이면 안 나간다
+
+
+# /chat 응답 캐시: 같은 프롬프트면 구글을 다시 부르지 않는다.
+# REDIS_URL 이 있으면 Redis, 없으면 프로세스 안 TTLCache.
+# 메모리 캐시는 조회/저장 사이에 await 가 없으니 이벤트 루프 안에서는 락이 필요 없다.
+CHAT_CACHE_MAX_PROMPT_BYTES = 8 * 1024  # 이보다 긴 프롬프트는 메모리 때문에 캐시 안 함
+CHAT_CACHE_TTL = 3600  # 초
+CHAT_CACHE_REDIS_PREFIX = b"ymc:chat:"
+REDIS_TIMEOUT = 0.5  # 초, 풀에서 연결 기다리기/연결/읽기 각각의 최대 시간
+_chat_cache: TTLCache = TTLCache(maxsize=4096, ttl=CHAT_CACHE_TTL)
+_redis: redis.asyncio.Redis | None = None
+
+
+def chat_cache_key(prompt: str) -> bytes | None:
+    """프롬프트 → 캐시 키 (너무 길면 None = 캐시 안 함)"""
+    data = prompt.encode()
+    if len(data) > CHAT_CACHE_MAX_PROMPT_BYTES:
+        return None
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+async def chat_cache_get(key: bytes) -> dict | None:
+    if _redis is None:
+        return _chat_cache.get(key)
+    try:
+        raw = await _redis.get(CHAT_CACHE_REDIS_PREFIX + key)
+        return orjson.loads(raw) if raw is not None else None
+    except (redis.RedisError, orjson.JSONDecodeError):
+        # Redis 가 죽었거나 값이 깨져 있어도 /chat 은 돌아가야 하니 그냥 캐시 미스로 본다
+        return None
+
+
+async def chat_cache_set(key: bytes, result: dict) -> None:
+    if _redis is None:
+        _chat_cache[key] = result
+        return
+    try:
+        await _redis.set(CHAT_CACHE_REDIS_PREFIX + key, orjson.dumps(result), ex=CHAT_CACHE_TTL)
+    except redis.RedisError:
+        pass
+
+
+class SemanticCache:
+    """
+    말만 바꾼 비슷한 프롬프트("프랑스 수도는?" / "프랑스의 수도가 어디야?")도
+    임베딩 코사인 유사도로 찾아서 이전 응답을 재사용한다.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        threshold: float = 0.92,
+        max_entries: int = 4096,
+        ttl: float = CHAT_CACHE_TTL,
+    ):
+        # 선택 의존성이라 켰을 때만 import
+        import faiss
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+        self.index = faiss.IndexFlatIP(self.model.get_sentence_embedding_dimension())
+        # index 의 i 번째 벡터 ↔ entries[i] = (expires_at, response)
+        self.entries: list[tuple[float, dict]] = []
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    async def embed(self, prompt: str):
+        """
+        프롬프트 임베딩. 모델 입력 길이(max_seq_length)를 넘으면 None.
+        넘는 부분은 잘려서 앞부분만 같은 다른 프롬프트와 구분이 안 되니 아예 캐시하지 않는다.
+        """
+        # 토큰화/임베딩 계산은 CPU 작업이라 이벤트 루프 밖에서 돌린다
+        return await asyncio.to_thread(self._embed_if_fits, prompt)
+
+    def _embed_if_fits(self, prompt: str):
+        n_tokens = len(self.model.tokenizer(prompt)["input_ids"])  # 특수 토큰 포함
+        if n_tokens > self.model.max_seq_length:
+            return None
+        return self.model.encode([prompt], normalize_embeddings=True).astype("float32")
+
+    def lookup(self, vec) -> dict | None:
+        if not self.entries:
+            return None
+        scores, ids = self.index.search(vec, 1)
+        if scores[0][0] <= self.threshold:
+            return None
+        expires_at, result = self.entries[ids[0][0]]
+        if expires_at <= time.monotonic():
+            # 정확 일치 캐시와 같은 TTL 이 지났으면 미스. 만료된 것들은 이참에 치운다
+            self.evict_expired()
+            return None
+        return result
+
+    def store(self, vec, result: dict) -> None:
+        if len(self.entries) >= self.max_entries:
+            self.evict_expired()
+        if len(self.entries) >= self.max_entries:
+            # 만료된 게 없어도 꽉 찼으면 비우고 새로 시작 (새 항목을 버리지 않는다)
+            self.index.reset()
+            self.entries.clear()
+        self.index.add(vec)
+        self.entries.append((time.monotonic() + self.ttl, result))
+
+    def evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [i for i, (expires_at, _) in enumerate(self.entries) if expires_at <= now]
+        if not expired:
+            return
+        # IndexFlat 의 remove_ids 는 남은 벡터의 순서를 유지하니 entries 도 같은 순서로 거른다
+        import numpy as np
+
+        self.index.remove_ids(np.array(expired, dtype="int64"))
+        self.entries = [entry for entry in self.entries if entry[0] > now]
+
+
+_semantic_cache = SemanticCache() if SEMANTIC_CACHE else None
+
+
+async def list_models_v1beta() -> list[dict]:
     """내 계정에서 실제로 보이는 모델 목록을 가져온다."""
-    url = f"{V1BETA_BASE_URL}?key={GEMINI_API_KEY}"
-    r = requests.get(url, timeout=30)
-    data = r.json()
+    r = await get_client().get(_MODELS_PATH, params=_KEY_PARAMS)
+    data = orjson.loads(r.content)
     if r.status_code != 200:
         raise HTTPException(status_code=r.status_code, detail=data)
     return data.get("models", [])
@@ -71,36 +274,82 @@ def pick_text_model(models: list[dict]) -> str:
     )
 
 
-def call_google_generate(model_name: str, payload: dict) -> dict:
-    """선택된 모델 이름으로 generateContent 호출"""
-    url = f"https://generativelanguage.googleapis.com/v1beta/{model_name}:generateContent"
-    r = requests.post(url + f"?key={GEMINI_API_KEY}", json=payload, timeout=30)
-    data = r.json()
+# 고른 모델은 몇 주 단위로나 바뀌니 요청마다 목록을 다시 받지 않고 잠깐 들고 있는다
+MODEL_CACHE_TTL = 3600  # 초
+MODEL_WARMUP_TIMEOUT = 5  # 초, 시작할 때 미리 고르기에 쓰는 최대 시간
+MODEL_REFRESH_BACKOFF = 60  # 초, 갱신 실패 시 예전 모델을 계속 쓰다가 다시 시도하기까지
+_text_model: tuple[str, float] | None = None  # (model_name, expires_at)
+_text_model_lock = asyncio.Lock()
+
+
+async def get_text_model() -> str:
+    """캐시된 텍스트 모델 이름. 만료됐으면 목록을 다시 받아서 고른다."""
+    global _text_model
+    if _text_model is not None and _text_model[1] > time.monotonic():
+        return _text_model[0]
+    # 동시에 만료를 본 요청들이 목록을 여러 번 받지 않도록 한 번만 갱신
+    async with _text_model_lock:
+        if _text_model is None or _text_model[1] <= time.monotonic():
+            try:
+                model_name = pick_text_model(await list_models_v1beta())
+            except (HTTPException, httpx.HTTPError, ValueError) as exc:
+                if _text_model is None:
+                    raise  # 쓸 수 있는 모델이 아예 없으면 어쩔 수 없다
+                # 목록만 못 받은 거고 예전에 고른 모델은 아마 아직 쓸 수 있다 → 잠깐 더 쓰고 나중에 다시 시도
+                logger.warning("모델 목록 갱신 실패, %s 를 계속 씀: %r", _text_model[0], exc)
+                _text_model = (_text_model[0], time.monotonic() + MODEL_REFRESH_BACKOFF)
+            else:
+                _text_model = (model_name, time.monotonic() + MODEL_CACHE_TTL)
+        return _text_model[0]
+
+
+def clear_text_model_cache() -> None:
+    global _text_model
+    _text_model = None
+
+
+@lru_cache(maxsize=16)
+def generate_path(model_name: str) -> str:
+    """모델 이름 → generateContent 경로 (모델 수가 적으니 한 번 만들고 재사용)"""
+    return f"/v1beta/{model_name}:generateContent"
+
+
+def build_text_payload(prompt: str) -> bytes:
+    """텍스트 프롬프트 하나짜리 generateContent 본문 (orjson 으로 바로 bytes 로 직렬화)"""
+    return orjson.dumps({"contents": [{"role": "user", "parts": [{"text": prompt}]}]})
+
+
+async def call_google_generate(model_name: str, payload: bytes) -> dict:
+    """선택된 모델 이름으로 generateContent 호출 (payload 는 이미 직렬화된 JSON)"""
+    r = await get_client().post(
+        generate_path(model_name), params=_KEY_PARAMS, content=payload, headers=_JSON_HEADERS
+    )
+    data = orjson.loads(r.content)
     if r.status_code != 200:
         raise HTTPException(status_code=r.status_code, detail=data.get("error", data))
     return data
 
 
-@app.post("/chat", dependencies=[Depends(verify_api_key)])
-async def chat(req: ChatRequest):
-    # 1) 실제로 내 계정에 어떤 모델이 열려있는지 본다
-    models = list_models_v1beta()
-
-    # 2) 그중에서 generateContent 되는 거 하나 고른다
-    model_name = pick_text_model(models)
+async def answer_chat(prompt: str, cache_key: bytes | None, response: Response) -> dict:
+    """캐시에 없을 때: 의미 캐시를 보고, 그래도 없으면 구글에 물어본 뒤 캐시에 넣는다."""
+    # 정확히 같진 않아도 의미가 거의 같은 프롬프트면 그 응답을 쓴다
+    # (정확 일치 캐시에서도 빠지는 긴 프롬프트는 여기서도 뺀다)
+    semantic_vec = None
+    if _semantic_cache is not None and cache_key is not None:
+        semantic_vec = await _semantic_cache.embed(prompt)
+    if semantic_vec is not None:
+        cached = _semantic_cache.lookup(semantic_vec)
+        if cached is not None:
+            response.headers["X-Cache"] = "HIT-SEMANTIC"
+            return cached
+    response.headers["X-Cache"] = "MISS"
+
+    # 1)+2) 내 계정에 열려있는 모델 중 generateContent 되는 거 하나 (캐시됨)
+    model_name = await get_text_model()
     # model_name 은 이렇게 생겼을 거야: "models/gemini-1.5-flash" 처럼 전체 경로
 
     # 3) 이제 그걸로 생성
-    payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": req.prompt}],
-            }
-        ]
-    }
-
-    result = call_google_generate(model_name, payload)
+    result = await call_google_generate(model_name, build_text_payload(prompt))
 
     # 4) 안전 파싱
     candidates = result.get("candidates", [])
@@ -110,17 +359,82 @@ async def chat(req: ChatRequest):
     parts = candidates[0].get("content", {}).get("parts", [])
     text = parts[0].get("text", "") if parts else ""
 
-    return {"response": text, "model_used": model_name}
+    result = {"response": text, "model_used": model_name}
+    if cache_key is not None:
+        await chat_cache_set(cache_key, result)
+    if semantic_vec is not None:
+        _semantic_cache.store(semantic_vec, result)
+    return result
+
+
+# 지금 구글에 가 있는 프롬프트들 (캐시 키 → 결과를 받을 Future)
+_inflight: dict[bytes, asyncio.Future] = {}
+
+
+# response_model 이 있으면 FastAPI 가 Pydantic 으로 바로 JSON bytes 를 만든다
+@app.post(
+    "/chat",
+    dependencies=[Depends(verify_api_key)],
+    response_model=ChatResponse,
+    response_model_exclude_none=True,
+)
+async def chat(req: ChatRequest, response: Response):
+    # 0) 같은 프롬프트를 최근에 처리했으면 캐시에서 바로 돌려준다
+    cache_key = chat_cache_key(req.prompt)
+    cached = await chat_cache_get(cache_key) if cache_key is not None else None
+    if cached is not None:
+        response.headers["X-Cache"] = "HIT"
+        return cached
+
+    if cache_key is None:
+        return await answer_chat(req.prompt, None, response)
+
+    # 0-1) 같은 프롬프트가 이미 구글에 가 있으면 새로 부르지 않고 그 결과를 같이 기다린다
+    while (inflight := _inflight.get(cache_key)) is not None:
+        try:
+            # 기다리던 쪽이 끊겨도 다른 요청들이 같이 기다리는 Future 는 취소되지 않게
+            result = await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            if not inflight.cancelled():
+                raise  # 이 요청 자체가 취소된 것
+            # 먼저 간 요청만 취소됐다 → 이 요청은 살아 있으니 다시 등록부터 시도
+            continue
+        response.headers["X-Cache"] = "HIT-INFLIGHT"
+        return result
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = fut
+    try:
+        result = await answer_chat(req.prompt, cache_key, response)
+    except Exception as exc:
+        fut.set_exception(exc)
+        fut.exception()  # 기다리는 요청이 없어도 "exception was never retrieved" 경고가 안 나게
+        raise
+    except BaseException:
+        fut.cancel()
+        raise
+    else:
+        fut.set_result(result)
+    finally:
+        _inflight.pop(cache_key, None)
+    return result
 
 
 # 디버깅용: 어떤 모델이 보이는지 바로 보기
 @app.get("/models/v1beta", dependencies=[Depends(verify_api_key)])
 async def models_v1beta():
-    return {"models": list_models_v1beta()}
+    return {"models": await list_models_v1beta()}
+
+
+# 모델 캐시 비우고 다시 고르기
+@app.post("/models/refresh", dependencies=[Depends(verify_api_key)])
+async def models_refresh():
+    clear_text_model_cache()
+    return {"model": await get_text_model()}
 
 
 @app.get("/")
-def root():
+async def root():
     return {"status": "ok", "version": "auto-pick-v1beta"}
 
 
@@ -132,6 +446,20 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     )
 
 
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop + httptools (uvicorn[standard] 에 포함). 워커마다 자기 httpx 커넥션 풀을 가진다
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop" if sys.platform != "win32" else "asyncio",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )
+
+
 
 
 
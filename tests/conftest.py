@@ -0,0 +1,9 @@
+import os
+import sys
+
+# main 은 import 시점에 환경변수를 읽으니 그 전에 테스트용 값을 넣어 둔다
+os.environ.setdefault("GEMINI_API_KEY", "test-gemini-key")
+os.environ["SEMANTIC_CACHE"] = "0"
+os.environ["REDIS_URL"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,142 @@
+"""/chat single-flight: 같은 프롬프트가 동시에 들어오면 구글은 한 번만 부른다."""
+import asyncio
+import time
+
+import httpx
+import orjson
+import pytest
+
+import main
+
+MODEL_NAME = "models/gemini-test"
+
+
+class FakeGoogle:
+    """generateContent 를 흉내 낸다. gate 가 열릴 때까지 응답을 붙잡고 있는다."""
+
+    def __init__(self, status_code: int = 200):
+        self.status_code = status_code
+        self.calls = 0
+        self.gate = asyncio.Event()
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == f"/v1beta/{MODEL_NAME}:generateContent"
+        self.calls += 1
+        await self.gate.wait()
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, json={"error": {"code": self.status_code, "message": "quota"}})
+        prompt = orjson.loads(request.content)["contents"][0]["parts"][0]["text"]
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": f"answer: {prompt}"}]}}]})
+
+
+@pytest.fixture(autouse=True)
+def reset_state(monkeypatch):
+    # 모델 목록 호출은 여기 관심사가 아니니 이미 골라 둔 상태로 시작
+    monkeypatch.setattr(main, "_text_model", (MODEL_NAME, time.monotonic() + 3600))
+    monkeypatch.setattr(main, "_text_model_lock", asyncio.Lock())
+    main._chat_cache.clear()
+    main._inflight.clear()
+    yield
+    main._chat_cache.clear()
+    main._inflight.clear()
+
+
+def run_with_google(fake: FakeGoogle, scenario):
+    async def run():
+        main._client = httpx.AsyncClient(base_url=main.GOOGLE_API_BASE_URL, transport=httpx.MockTransport(fake))
+        try:
+            return await scenario()
+        finally:
+            await main.close_client()
+
+    return asyncio.run(run())
+
+
+def start_chat(prompt: str) -> tuple[asyncio.Task, main.Response]:
+    response = main.Response()
+    task = asyncio.create_task(main.chat(main.ChatRequest(prompt=prompt), response))
+    return task, response
+
+
+async def settle():
+    # 만든 태스크들이 각자 await 지점(구글 호출 / inflight 대기)까지 가도록 루프를 몇 바퀴 돌린다
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_identical_prompts_share_one_upstream_call():
+    fake = FakeGoogle()
+
+    async def scenario():
+        chats = [start_chat("hello") for _ in range(5)]
+        await settle()
+        fake.gate.set()
+        results = await asyncio.gather(*(task for task, _ in chats))
+        return results, [response.headers["X-Cache"] for _, response in chats]
+
+    results, cache_headers = run_with_google(fake, scenario)
+
+    assert fake.calls == 1
+    assert results == [{"response": "answer: hello", "model_used": MODEL_NAME}] * 5
+    assert sorted(cache_headers) == ["HIT-INFLIGHT"] * 4 + ["MISS"]
+    assert main._inflight == {}
+
+
+def test_leader_error_reaches_followers():
+    fake = FakeGoogle(status_code=429)
+
+    async def scenario():
+        chats = [start_chat("hello") for _ in range(5)]
+        await settle()
+        fake.gate.set()
+        return await asyncio.gather(*(task for task, _ in chats), return_exceptions=True)
+
+    results = run_with_google(fake, scenario)
+
+    assert fake.calls == 1
+    assert all(isinstance(exc, main.HTTPException) and exc.status_code == 429 for exc in results)
+    assert main._inflight == {}
+
+
+def test_cancelled_leader_promotes_follower():
+    fake = FakeGoogle()
+
+    async def scenario():
+        leader, _ = start_chat("hello")
+        await settle()
+        followers = [start_chat("hello") for _ in range(2)]
+        await settle()
+        leader.cancel()
+        await settle()
+        fake.gate.set()
+        results = await asyncio.gather(*(task for task, _ in followers))
+        return leader, results
+
+    leader, results = run_with_google(fake, scenario)
+
+    assert leader.cancelled()
+    # 취소된 첫 요청 + 그 자리를 이어받은 요청 하나. 나머지는 그걸 같이 기다린다
+    assert fake.calls == 2
+    assert results == [{"response": "answer: hello", "model_used": MODEL_NAME}] * 2
+    assert main._inflight == {}
+
+
+def test_cancelled_follower_does_not_affect_others():
+    fake = FakeGoogle()
+
+    async def scenario():
+        leader, _ = start_chat("hello")
+        await settle()
+        (cancelled, _), (follower, _) = start_chat("hello"), start_chat("hello")
+        await settle()
+        cancelled.cancel()
+        await settle()
+        fake.gate.set()
+        return cancelled, await leader, await follower
+
+    cancelled, leader_result, follower_result = run_with_google(fake, scenario)
+
+    assert cancelled.cancelled()
+    assert fake.calls == 1
+    assert leader_result == follower_result == {"response": "answer: hello", "model_used": MODEL_NAME}
+    assert main._inflight == {}